@@ -1,17 +1,22 @@
 import pandas as pd
 import numpy as np
-import random
+import pyarrow as pa
+import pyarrow.dataset as ds
 import os
-from datetime import datetime, timedelta
+import shutil
+from datetime import datetime, timedelta, timezone
 import sys
 
 # Create data directory if it doesn't exist
 os.makedirs('data', exist_ok=True)
 
+# Single seeded generator shared by all random draws, for reproducible data
+rng = np.random.default_rng(42)
+
 # Generate songs metadata
 def generate_songs_metadata(num_songs=1000):
     print("Generating songs metadata...")
-    song_ids = [f"S{str(i).zfill(4)}" for i in range(1, num_songs+1)]
+    song_ids = np.char.add("S", np.char.zfill(np.arange(1, num_songs+1).astype(str), 4))
     
     # Song title patterns
     adjectives = ["Beautiful", "Crazy", "Dark", "Electric", "Fantastic", "Golden", "Happy", "Infinite", 
@@ -30,139 +35,141 @@ def generate_songs_metadata(num_songs=1000):
     
     moods = ["Happy", "Sad", "Energetic", "Chill", "Romantic", "Melancholic", "Nostalgic", "Upbeat", "Dreamy", "Intense"]
     
-    # Generate song titles
-    titles = []
-    used_titles = set()
-    
-    # Progress tracking
-    progress_interval = max(1, num_songs // 10)
+    # Generate song titles by sampling unique adjective/noun pairs without replacement
+    combos = np.array([f"{a} {n}" for a in adjectives for n in nouns])
+    num_unique = min(num_songs, len(combos))
+    titles = combos[rng.choice(len(combos), size=num_unique, replace=False)].tolist()
     
-    for i in range(num_songs):
-        # Progress reporting
-        if i % progress_interval == 0:
-            print(f"Generating song {i}/{num_songs} ({(i/num_songs)*100:.1f}%)...")
-            sys.stdout.flush()
-            
-        # Instead of potentially infinite loop, use a counter
-        attempts = 0
-        max_attempts = 100
-        
-        while attempts < max_attempts:
-            title = f"{random.choice(adjectives)} {random.choice(nouns)}"
-            if title not in used_titles:
-                used_titles.add(title)
-                titles.append(title)
-                break
-            attempts += 1
-            
-        # If we couldn't generate a unique title, add a number suffix
-        if attempts >= max_attempts:
-            title = f"{random.choice(adjectives)} {random.choice(nouns)} {i}"
-            used_titles.add(title)
-            titles.append(title)
+    # If there are more songs than unique titles, add a number suffix
+    for i in range(num_unique, num_songs):
+        titles.append(f"{combos[i % len(combos)]} {i}")
     
     # Create dataframe
     print("Creating songs dataframe...")
     songs_df = pd.DataFrame({
         'song_id': song_ids,
         'title': titles,
-        'artist': [random.choice(artists) for _ in range(num_songs)],
-        'genre': [random.choice(genres) for _ in range(num_songs)],
-        'mood': [random.choice(moods) for _ in range(num_songs)]
+        'artist': rng.choice(np.asarray(artists), size=num_songs),
+        'genre': rng.choice(np.asarray(genres), size=num_songs),
+        'mood': rng.choice(np.asarray(moods), size=num_songs)
     })
     
-    # Save to CSV
-    print("Saving songs to CSV...")
-    songs_df.to_csv('data/songs_metadata.csv', index=False)
-    print(f"Generated {num_songs} songs in data/songs_metadata.csv")
+    # Save to Parquet
+    print("Saving songs to Parquet...")
+    songs_df.to_parquet('data/songs_metadata.parquet', engine='pyarrow', compression='snappy', index=False)
+    print(f"Generated {num_songs} songs in data/songs_metadata.parquet")
     return songs_df
 
 # Generate listening logs
 def generate_listening_logs(songs_df, num_users=100, days=30, avg_plays_per_user_per_day=5):
     print("Generating listening logs...")
     user_ids = [f"U{str(i).zfill(4)}" for i in range(1, num_users+1)]
-    song_ids = songs_df['song_id'].tolist()
+    song_ids = songs_df['song_id'].to_numpy()
+    
+    # Song attributes as arrays so per-user weights can be built without iterating rows
+    genres = songs_df['genre'].to_numpy()
+    moods = songs_df['mood'].to_numpy()
+    unique_genres = songs_df['genre'].unique().tolist()
+    unique_moods = songs_df['mood'].unique().tolist()
     
     # Create end date as today and start date as 30 days ago
-    end_date = datetime.now()
+    # (in UTC, so the stored timestamps are unambiguous instants)
+    end_date = datetime.now(timezone.utc)
     start_date = end_date - timedelta(days=days)
-    
-    # Lists to store the data
-    log_user_ids = []
-    log_song_ids = []
-    log_timestamps = []
-    log_durations = []
+    span_seconds = int((end_date - start_date).total_seconds())
+    
+    # Logs are streamed to Parquet one user at a time, partitioned by date so
+    # date filters can skip whole files, replacing any previous run
+    logs_dir = 'data/listening_logs'
+    if os.path.exists(logs_dir):
+        shutil.rmtree(logs_dir)
+    
+    # Timestamps are stored natively as UTC-adjusted microseconds, which Spark
+    # reads as a regular TimestampType.
+    logs_schema = pa.schema([
+        ('user_id', pa.string()),
+        ('song_id', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('duration_sec', pa.int32()),
+        ('hour', pa.int8()),
+        ('date', pa.string())
+    ])
     
     # Progress tracking
     progress_interval = max(1, num_users // 10)
+    total_records = 0
     
-    # For each user
-    for i, user_id in enumerate(user_ids):
-        # Progress reporting
-        if i % progress_interval == 0:
-            print(f"Generating logs for user {i}/{num_users} ({(i/num_users)*100:.1f}%)...")
-            sys.stdout.flush()
+    def user_batches():
+        nonlocal total_records
+            
+        # For each user
+        for i, user_id in enumerate(user_ids):
+            # Progress reporting
+            if i % progress_interval == 0:
+                print(f"Generating logs for user {i}/{num_users} ({(i/num_users)*100:.1f}%)...")
+                sys.stdout.flush()
             
-        # Assign genre and mood preferences to users
-        fav_genres = random.sample(songs_df['genre'].unique().tolist(), k=min(3, len(songs_df['genre'].unique())))
-        fav_moods = random.sample(songs_df['mood'].unique().tolist(), k=min(3, len(songs_df['mood'].unique())))
-        
-        # Weighted song selection based on preferences
-        song_weights = []
-        for _, song in songs_df.iterrows():
-            weight = 1.0
-            if song['genre'] in fav_genres:
-                weight *= 3.0  # Higher weight for favorite genres
-            if song['mood'] in fav_moods:
-                weight *= 2.0  # Higher weight for favorite moods
-            song_weights.append(weight)
-        
-        # Normalize weights
-        total_weight = sum(song_weights)
-        if total_weight > 0:
-            song_weights = [w/total_weight for w in song_weights]
-        else:
-            song_weights = [1.0/len(song_weights) for _ in song_weights]
-        
-        # Generate random number of plays for this user
-        num_plays = int(np.random.normal(avg_plays_per_user_per_day * days, avg_plays_per_user_per_day * days / 4))
-        num_plays = max(1, num_plays)  # At least 1 play
-        
-        for _ in range(num_plays):
-            # Select song based on preferences
-            song_idx = np.random.choice(len(song_ids), p=song_weights)
-            song_id = song_ids[song_idx]
+            # Assign genre and mood preferences to users
+            fav_genres = rng.choice(unique_genres, size=min(3, len(unique_genres)), replace=False)
+            fav_moods = rng.choice(unique_moods, size=min(3, len(unique_moods)), replace=False)
             
-            # Generate random timestamp within the date range
-            random_seconds = random.randint(0, int((end_date - start_date).total_seconds()))
-            timestamp = start_date + timedelta(seconds=random_seconds)
+            # Which songs match this user's preferences
+            is_fav_genre = np.isin(genres, fav_genres)
+            is_fav_mood = np.isin(moods, fav_moods)
+            is_fav_song = is_fav_genre | is_fav_mood
+            
+            # Weighted song selection based on preferences
+            song_weights = np.ones(len(song_ids))
+            song_weights[is_fav_genre] *= 3.0  # Higher weight for favorite genres
+            song_weights[is_fav_mood] *= 2.0  # Higher weight for favorite moods
+            
+            # Cumulative weights for inverse-CDF sampling (no normalization needed)
+            cum_weights = np.cumsum(song_weights)
+            total_weight = cum_weights[-1]
+            
+            # Generate random number of plays for this user
+            num_plays = int(rng.normal(avg_plays_per_user_per_day * days, avg_plays_per_user_per_day * days / 4))
+            num_plays = max(1, num_plays)  # At least 1 play
+            
+            # Select all songs for this user in one draw based on preferences
+            song_idx = cum_weights.searchsorted(rng.random(num_plays) * total_weight, side='right')
             
             # Generate duration (between 30 seconds and 5 minutes)
-            # Higher probability of full song play for favorite genres/moods
-            if songs_df.iloc[song_idx]['genre'] in fav_genres or songs_df.iloc[song_idx]['mood'] in fav_moods:
-                # Full song play for favorites (3-5 minutes)
-                duration = random.randint(180, 300)
-            else:
-                # More variable play time for non-favorites (30 sec - 5 min)
-                duration = random.randint(30, 300)
+            # Higher probability of full song play for favorite genres/moods:
+            # full song play for favorites (3-5 minutes), more variable play
+            # time for non-favorites (30 sec - 5 min)
+            durations = np.where(is_fav_song[song_idx],
+                                 rng.integers(180, 301, size=num_plays),
+                                 rng.integers(30, 301, size=num_plays))
             
-            log_user_ids.append(user_id)
-            log_song_ids.append(song_id)
-            log_timestamps.append(timestamp.strftime('%Y-%m-%d %H:%M:%S'))
-            log_durations.append(duration)
-    
-    print("Creating listening logs dataframe...")
-    logs_df = pd.DataFrame({
-        'user_id': log_user_ids,
-        'song_id': log_song_ids,
-        'timestamp': log_timestamps,
-        'duration_sec': log_durations
-    })
-    
-    # Save to CSV
-    print("Saving listening logs to CSV...")
-    logs_df.to_csv('data/listening_logs.csv', index=False)
-    print(f"Generated {len(logs_df)} listening records for {num_users} users in data/listening_logs.csv")
+            # Generate random timestamps within the date range
+            random_seconds = rng.integers(0, span_seconds + 1, size=num_plays, dtype=np.int64)
+            timestamps = np.datetime64(start_date.replace(tzinfo=None), 's') + random_seconds.astype('timedelta64[s]')
+            
+            # Date and hour are in UTC, like the timestamps themselves
+            play_dates = timestamps.astype('datetime64[D]')
+            play_hours = (timestamps - play_dates).astype('timedelta64[h]').astype(np.int8)
+            
+            # Build this user's batch; the dataset writer splits it by date
+            total_records += num_plays
+            yield pa.RecordBatch.from_arrays([
+                pa.array(np.full(num_plays, user_id)),
+                pa.array(song_ids[song_idx]),
+                pa.array(timestamps.astype('datetime64[us]'), type=pa.timestamp('us', tz='UTC')),
+                pa.array(durations.astype(np.int32)),
+                pa.array(play_hours),
+                pa.array(play_dates.astype(str))
+            ], schema=logs_schema)
+    
+    # Rows are queued per date until a full row group is ready, so per-user
+    # batches do not become tiny row groups (max_rows_queued still caps memory)
+    print("Streaming listening logs to Parquet...")
+    ds.write_dataset(user_batches(), logs_dir, schema=logs_schema, format='parquet',
+                     partitioning=['date'], partitioning_flavor='hive',
+                     basename_template='part-{i}.snappy.parquet',
+                     file_options=ds.ParquetFileFormat().make_write_options(compression='snappy'),
+                     min_rows_per_group=100000, max_rows_per_group=100000)
+    print(f"Generated {total_records} listening records for {num_users} users in {logs_dir}/")
 
 if __name__ == "__main__":
     try:
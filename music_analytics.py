@@ -1,16 +1,40 @@
 from pyspark.sql import SparkSession
 from pyspark.sql import functions as F
 from pyspark.sql.window import Window
-from pyspark.sql.types import StructType, StructField, StringType, IntegerType, TimestampType
+from pyspark import StorageLevel
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import shutil
 
+# Input datasets written by data_generator.py
+LISTENING_LOGS_PATH = "data/listening_logs"
+SONGS_METADATA_PATH = "data/songs_metadata.parquet"
+
 def init_spark():
     """Initialize a Spark session"""
-    return (SparkSession.builder
-            .appName("Music Streaming Analytics")
-            .getOrCreate())
+    spark = (SparkSession.builder
+             .appName("Music Streaming Analytics")
+             .getOrCreate())
+    
+    # The generated date and hour columns are in UTC, so evaluate timestamps
+    # (F.hour, date comparisons) in UTC as well
+    spark.conf.set("spark.sql.session.timeZone", "UTC")
+    
+    # Allow the songs metadata table to be broadcast in joins
+    spark.conf.set("spark.sql.autoBroadcastJoinThreshold", 50 * 1024 * 1024)
+    
+    # Compressed columnar batches for cached DataFrames
+    spark.conf.set("spark.sql.inMemoryColumnarStorage.compressed", "true")
+    spark.conf.set("spark.sql.inMemoryColumnarStorage.batchSize", 10000)
+    
+    # The datasets are small, so use few shuffle partitions and let AQE
+    # coalesce them further at runtime
+    spark.conf.set("spark.sql.shuffle.partitions", 16)
+    spark.conf.set("spark.sql.adaptive.enabled", "true")
+    spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+    spark.conf.set("spark.sql.adaptive.localShuffleReader.enabled", "true")
+    
+    return spark
 
 def prepare_output_directory(base_dir="output"):
     """Create output directory structure, removing if it already exists"""
@@ -34,44 +58,26 @@ def prepare_output_directory(base_dir="output"):
     
 def load_data(spark):
     """Load the listening logs and songs metadata datasets"""
-    # Define schemas
-    logs_schema = StructType([
-        StructField("user_id", StringType(), False),
-        StructField("song_id", StringType(), False),
-        StructField("timestamp", StringType(), False),
-        StructField("duration_sec", IntegerType(), False)
-    ])
-    
-    songs_schema = StructType([
-        StructField("song_id", StringType(), False),
-        StructField("title", StringType(), False),
-        StructField("artist", StringType(), False),
-        StructField("genre", StringType(), False),
-        StructField("mood", StringType(), False)
-    ])
+    # Load data (Parquet files carry their own schema; logs are partitioned by date)
+    logs_df = spark.read.parquet(LISTENING_LOGS_PATH)
     
-    # Load data
-    logs_df = (spark.read.schema(logs_schema)
-              .option("header", "true")
-              .csv("data/listening_logs.csv")
-              .withColumn("timestamp", F.to_timestamp("timestamp")))
+    songs_df = spark.read.parquet(SONGS_METADATA_PATH)
     
-    songs_df = (spark.read.schema(songs_schema)
-               .option("header", "true")
-               .csv("data/songs_metadata.csv"))
+    # Logs are reused by several tasks, so keep them in memory
+    logs_df = logs_df.persist(StorageLevel.MEMORY_AND_DISK)
     
     # Create a common dataframe by joining logs and metadata
-    enriched_logs = logs_df.join(songs_df, on="song_id", how="inner")
+    # (songs metadata is small, so broadcast it to avoid shuffling the logs)
+    enriched_logs = logs_df.join(F.broadcast(songs_df), on="song_id", how="inner")
+    
+    # Enriched logs feed most of the tasks too; materialize both caches up front
+    enriched_logs = enriched_logs.persist(StorageLevel.MEMORY_AND_DISK)
+    enriched_logs.count()
     
     return logs_df, songs_df, enriched_logs
 
-def task1_user_favorite_genres(enriched_logs):
-    """Find each user's favorite genre by counting genre plays"""
-    user_genre_counts = (enriched_logs
-                        .groupBy("user_id", "genre")
-                        .count()
-                        .withColumnRenamed("count", "play_count"))
-    
+def task1_user_favorite_genres(user_genre_counts):
+    """Find each user's favorite genre from per-user genre play counts"""
     # Create a window spec to find the max play count for each user
     window_spec = Window.partitionBy("user_id").orderBy(F.desc("play_count"))
     
@@ -90,6 +96,7 @@ def task1_user_favorite_genres(enriched_logs):
 def task2_avg_listen_time_per_song(logs_df):
     """Calculate average listen time per song"""
     avg_listen_time = (logs_df
+                      .select("song_id", "duration_sec")
                       .groupBy("song_id")
                       .agg(
                           F.avg("duration_sec").alias("avg_duration_sec"),
@@ -102,30 +109,42 @@ def task2_avg_listen_time_per_song(logs_df):
     
     return avg_listen_time
 
-def task3_top_songs_this_week(enriched_logs, songs_df):
+def task3_top_songs_this_week(spark, songs_df):
     """List the top 10 most played songs this week"""
     # Calculate the start of the current week (last 7 days from now)
-    current_date = datetime.now()
+    current_date = datetime.now(timezone.utc)
     one_week_ago = current_date - timedelta(days=7)
     
-    # Filter logs for the current week and count plays per song
-    top_songs = (enriched_logs
-                .filter(F.col("timestamp") >= one_week_ago)
-                .groupBy("song_id", "title", "artist")
-                .count()
-                .withColumnRenamed("count", "play_count")
-                .orderBy(F.desc("play_count"))
-                .limit(10))
+    # Read the logs directly rather than the cached enriched logs, so the date
+    # filter prunes whole date partitions at file-listing time. Then count plays
+    # per song; orderBy + limit is planned as a per-partition top-K, so only 10
+    # rows per partition are merged
+    top_song_counts = (spark.read.parquet(LISTENING_LOGS_PATH)
+                      .filter(F.col("date") >= F.lit(one_week_ago.date()))
+                      .select("song_id", "timestamp")
+                      .filter(F.col("timestamp") >= one_week_ago)
+                      .groupBy("song_id")
+                      .count()
+                      .withColumnRenamed("count", "play_count")
+                      .orderBy(F.desc("play_count"))
+                      .limit(10))
+    
+    # Look up title and artist for the top songs only
+    top_songs = (top_song_counts
+                .join(F.broadcast(songs_df.select("song_id", "title", "artist")), on="song_id")
+                .select("song_id", "title", "artist", "play_count")
+                .orderBy(F.desc("play_count")))
     
     top_songs.write.mode("overwrite").json("output/top_songs_this_week/")
     print("Task 3: Top songs this week saved to output/top_songs_this_week/")
     
     return top_songs
 
-def task4_happy_song_recommendations(enriched_logs, songs_df, spark):
+def task4_happy_song_recommendations(enriched_logs, songs_df):
     """Recommend 'Happy' songs to users who mostly listen to 'Sad' songs"""
     # Find users who primarily listen to sad songs
     mood_counts = (enriched_logs
+                  .select("user_id", "mood")
                   .groupBy("user_id", "mood")
                   .count())
     
@@ -136,8 +155,9 @@ def task4_happy_song_recommendations(enriched_logs, songs_df, spark):
                          .filter((F.col("rank") == 1) & (F.col("mood") == "Sad"))
                          .select("user_id"))
     
-    # Find all songs user has listened to
+    # Find all happy songs each user has listened to (only those can be excluded)
     user_songs = (enriched_logs
+                 .filter(F.col("mood") == "Happy")
                  .select("user_id", "song_id")
                  .distinct())
     
@@ -145,72 +165,32 @@ def task4_happy_song_recommendations(enriched_logs, songs_df, spark):
     happy_songs = (songs_df
                   .filter(F.col("mood") == "Happy"))
     
-    # For each user, find happy songs they haven't listened to yet
-    recommendations = []
+    # Pair every sad listener with every happy song, drop the ones they have
+    # already listened to, and pick 3 random songs per user
+    random_window = Window.partitionBy("user_id").orderBy(F.rand())
     
-    for user_row in sad_song_listeners.collect():
-        user_id = user_row["user_id"]
-        
-        # Get songs this user has already listened to
-        user_listened_songs = (user_songs
-                              .filter(F.col("user_id") == user_id)
-                              .select("song_id")
-                              .rdd.flatMap(lambda x: x).collect())
-        
-        # Find happy songs they haven't listened to
-        user_recommendations = (happy_songs
-                               .filter(~F.col("song_id").isin(user_listened_songs))
-                               .orderBy(F.rand())  # Random selection
-                               .limit(3)
-                               .withColumn("user_id", F.lit(user_id))
-                               .select("user_id", "song_id", "title", "artist"))
-        
-        recommendations.append(user_recommendations)
-    
-    # Combine all recommendations
-    if recommendations:
-        final_recommendations = recommendations[0]
-        for i in range(1, len(recommendations)):
-            final_recommendations = final_recommendations.union(recommendations[i])
-    else:
-        # Create empty DataFrame with appropriate schema if there are no recommendations
-        final_recommendations = spark.createDataFrame([], 
-                                                    StructType([
-                                                        StructField("user_id", StringType(), True),
-                                                        StructField("song_id", StringType(), True),
-                                                        StructField("title", StringType(), True),
-                                                        StructField("artist", StringType(), True)
-                                                    ]))
+    final_recommendations = (sad_song_listeners
+                            .crossJoin(F.broadcast(happy_songs.select("song_id", "title", "artist")))
+                            .join(user_songs, on=["user_id", "song_id"], how="left_anti")
+                            .withColumn("rank", F.row_number().over(random_window))
+                            .filter(F.col("rank") <= 3)
+                            .select("user_id", "song_id", "title", "artist"))
     
     final_recommendations.write.mode("overwrite").json("output/happy_recommendations/")
     print("Task 4: Happy song recommendations saved to output/happy_recommendations/")
     
     return final_recommendations
 
-def task5_genre_loyalty_scores(enriched_logs):
-    """Compute genre loyalty score for each user"""
-    # Count total plays per user
-    user_total_plays = (enriched_logs
-                       .groupBy("user_id")
-                       .count()
-                       .withColumnRenamed("count", "total_plays"))
-    
-    # Count plays per user per genre
-    user_genre_plays = (enriched_logs
-                       .groupBy("user_id", "genre")
-                       .count()
-                       .withColumnRenamed("count", "genre_plays"))
-    
-    # Find max genre plays for each user
+def task5_genre_loyalty_scores(user_genre_counts):
+    """Compute genre loyalty score for each user from per-user genre play counts"""
+    # Derive total plays and max genre plays for each user from the same counts
     window_spec = Window.partitionBy("user_id")
     
-    user_max_genre = (user_genre_plays
-                     .withColumn("max_genre_plays", F.max("genre_plays").over(window_spec))
-                     .filter(F.col("genre_plays") == F.col("max_genre_plays"))
-                     .select("user_id", "genre", "max_genre_plays"))
-    
-    # Join with total plays and calculate loyalty score
-    loyalty_scores = (user_max_genre.join(user_total_plays, on="user_id")
+    # Keep each user's top genre and calculate loyalty score
+    loyalty_scores = (user_genre_counts
+                     .withColumn("total_plays", F.sum("play_count").over(window_spec))
+                     .withColumn("max_genre_plays", F.max("play_count").over(window_spec))
+                     .filter(F.col("play_count") == F.col("max_genre_plays"))
                      .withColumn("loyalty_score", F.col("max_genre_plays") / F.col("total_plays"))
                      .filter(F.col("loyalty_score") > 0.8)
                      .select("user_id", "genre", "loyalty_score")
@@ -222,10 +202,10 @@ def task5_genre_loyalty_scores(enriched_logs):
     return loyalty_scores
 
 def task6_night_owl_users(logs_df):
-    """Identify users who listen to music between 12 AM and 5 AM"""
+    """Identify users who listen to music between 12 AM and 5 AM (UTC)"""
     night_owl_users = (logs_df
-                      .withColumn("hour", F.hour("timestamp"))
-                      .filter((F.col("hour") >= 0) & (F.col("hour") < 5))
+                      .select("user_id", "hour")
+                      .filter(F.col("hour") < 5)
                       .groupBy("user_id")
                       .count()
                       .withColumnRenamed("count", "night_plays")
@@ -255,12 +235,23 @@ if __name__ == "__main__":
     print(f"Loaded {logs_df.count()} listening logs")
     print(f"Loaded {songs_df.count()} songs")
     
+    # Count plays per user per genre once, shared by tasks 1 and 5
+    user_genre_counts = (enriched_logs
+                        .select("user_id", "genre")
+                        .groupBy("user_id", "genre")
+                        .count()
+                        .withColumnRenamed("count", "play_count")
+                        .persist())
+    
     # Execute all tasks
-    task1_user_favorite_genres(enriched_logs)
+    task1_user_favorite_genres(user_genre_counts)
     task2_avg_listen_time_per_song(logs_df)
-    task3_top_songs_this_week(enriched_logs, songs_df)
-    task4_happy_song_recommendations(enriched_logs, songs_df, spark)
-    task5_genre_loyalty_scores(enriched_logs)
+    # Task 3 re-reads the log files instead of the cached logs so its date
+    # filter can prune partitions; keep it off enriched_logs
+    task3_top_songs_this_week(spark, songs_df)
+    task4_happy_song_recommendations(enriched_logs, songs_df)
+    task5_genre_loyalty_scores(user_genre_counts)
+    user_genre_counts.unpersist()
     task6_night_owl_users(logs_df)
     save_enriched_logs(enriched_logs)
     